@@ -1,163 +1,500 @@
-import json
-import boto3
+import orjson
 import os
+import time
+import random
+import hashlib
+import threading
 import requests
-from typing import Dict, List, Any
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from requests.auth import AuthBase
+from urllib3.util.retry import Retry
+import numpy as np
+from typing import Dict, List, Any, Optional, Tuple
 import logging
-from opensearchpy import OpenSearch, RequestsHttpConnection
-from aws_requests_auth.aws_auth import AWSRequestsAuth
+from botocore.auth import SigV4Auth
+from botocore.awsrequest import AWSRequest
+from botocore.config import Config
+from botocore.session import Session
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
-# Initialize AWS clients
-secrets_client = boto3.client('secretsmanager')
-cloudwatch = boto3.client('cloudwatch')
+# Initialize AWS clients from a plain botocore session (skips boto3's resource machinery)
+session = Session()
+aws_client_config = Config(
+    tcp_keepalive=True,
+    retries={'max_attempts': 3, 'mode': 'adaptive'},
+    max_pool_connections=10
+)
+secrets_client = session.create_client('secretsmanager', config=aws_client_config)
 
 # Environment variables
-OPENSEARCH_ENDPOINT = os.environ['OPENSEARCH_ENDPOINT']
+OPENSEARCH_ENDPOINT = os.environ['OPENSEARCH_ENDPOINT'].rstrip('/')
+OPENSEARCH_TIMEOUT = 10
 LLM_API_KEY_SECRET = os.environ['LLM_API_KEY_SECRET']
 EXTERNAL_LLM_ENDPOINT = os.environ['EXTERNAL_LLM_ENDPOINT']
+REDIS_ENDPOINT = os.environ.get('REDIS_ENDPOINT', '')
+LLM_VECTOR_STORE_ID = os.environ.get('LLM_VECTOR_STORE_ID', '')
+RESPONSES_MODEL = os.environ.get('RESPONSES_MODEL', 'gpt-4.1')
+EMBEDDING_CACHE_TTL = int(os.environ.get('EMBEDDING_CACHE_TTL', '3600'))
+# Max inputs per embeddings call; lower it for providers with small input caps (some cap at 16).
+# Only when a request has more cache misses than this (MAX_BATCH_QUERIES above it) are batches sent concurrently
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', '256'))
+EMBEDDING_MAX_INFLIGHT = int(os.environ.get('EMBEDDING_MAX_INFLIGHT', '4'))
+CONTEXT_TOKEN_LIMIT = int(os.environ.get('CONTEXT_TOKEN_LIMIT', '6000'))
+MAX_COMPLETION_TOKENS = 500
+MAX_QUERY_CHARS = 4000
+MAX_BATCH_QUERIES = int(os.environ.get('MAX_BATCH_QUERIES', '8'))
+MMR_LAMBDA = float(os.environ.get('MMR_LAMBDA', '0.5'))
+MMR_FETCH_MULTIPLIER = 3
+
+# Initialize Redis (ElastiCache) client for the embedding cache
+redis_client = None
+if REDIS_ENDPOINT:
+    import redis
+    redis_client = redis.Redis(
+        connection_pool=redis.ConnectionPool(
+            host=REDIS_ENDPOINT,
+            port=int(os.environ.get('REDIS_PORT', '6379')),
+            socket_timeout=0.2,
+            socket_connect_timeout=0.2
+        )
+    )
+
+class SigV4RequestsAuth(AuthBase):
+    """Sign requests.Session calls to OpenSearch with SigV4 using refreshable botocore credentials"""
+    
+    def __init__(self, credentials, region: str, service: str):
+        self.credentials = credentials
+        self.region = region
+        self.service = service
+    
+    def __call__(self, request):
+        body = request.body or b''
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        headers = {
+            'Content-Type': request.headers.get('Content-Type', 'application/json'),
+            'X-Amz-Content-SHA256': hashlib.sha256(body).hexdigest()
+        }
+        aws_request = AWSRequest(method=request.method, url=request.url, data=body, headers=headers)
+        SigV4Auth(self.credentials.get_frozen_credentials(), self.service, self.region).add_auth(aws_request)
+        request.headers.update(dict(aws_request.headers.items()))
+        return request
 
-# Initialize OpenSearch client
-host = OPENSEARCH_ENDPOINT.replace('https://', '')
+# OpenSearch request signing
 region = os.environ['AWS_REGION']
 service = 'aoss'
-credentials = boto3.Session().get_credentials()
-awsauth = AWSRequestsAuth(credentials, region, service)
-
-opensearch_client = OpenSearch(
-    hosts=[{'host': host, 'port': 443}],
-    http_auth=awsauth,
-    use_ssl=True,
-    verify_certs=True,
-    connection_class=RequestsHttpConnection
-)
+awsauth = SigV4RequestsAuth(session.get_credentials(), region, service)
+
+# Shared HTTP session so warm containers reuse the TLS connections to the LLM API and OpenSearch
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=8,
+    # Only retry the listed statuses and failed connects; a read timeout on a billed POST is not resent,
+    # and Retry-After is ignored so a 429 cannot sleep past the function timeout
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.2,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=frozenset(['POST']),
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+))
+
+# Worker pool used to overlap independent I/O within an invocation
+executor = ThreadPoolExecutor(max_workers=3)
+_opensearch_warmed = False
 
 def get_secret(secret_name: str) -> Dict[str, Any]:
     """Retrieve secret from AWS Secrets Manager"""
     try:
         response = secrets_client.get_secret_value(SecretId=secret_name)
-        return json.loads(response['SecretString'])
+        return orjson.loads(response['SecretString'])
     except Exception as e:
         logger.error(f"Error retrieving secret: {str(e)}")
         raise
 
-def generate_embedding(text: str) -> List[float]:
-    """Generate embedding using external LLM API"""
-    try:
-        secret = get_secret(LLM_API_KEY_SECRET)
-        api_key = secret['api_key']
-        
+# Fetch the LLM API key once per container; falls back to a lazy fetch on first use
+try:
+    _LLM_API_KEY = get_secret(LLM_API_KEY_SECRET)['api_key']
+except Exception:
+    _LLM_API_KEY = None
+
+def get_llm_api_key(refresh: bool = False) -> str:
+    """Return the cached LLM API key, re-reading Secrets Manager when refresh is set"""
+    global _LLM_API_KEY
+    if refresh or _LLM_API_KEY is None:
+        _LLM_API_KEY = get_secret(LLM_API_KEY_SECRET)['api_key']
+    return _LLM_API_KEY
+
+def post_to_llm(path: str, payload: Dict[str, Any], timeout: int) -> requests.Response:
+    """POST to the external LLM API, refreshing the API key once on a 401 (key rotation)"""
+    response = None
+    for refresh in (False, True):
         headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Example for OpenAI API - adjust based on your LLM provider
-        payload = {
-            'input': text,
-            'model': 'text-embedding-ada-002'
+            'Authorization': f'Bearer {get_llm_api_key(refresh=refresh)}',
+            'Content-Type': 'application/json',
+            'Connection': 'keep-alive'
         }
-        
-        response = requests.post(
-            f"{EXTERNAL_LLM_ENDPOINT}/embeddings",
+        response = SESSION.post(
+            f"{EXTERNAL_LLM_ENDPOINT}{path}",
             headers=headers,
-            json=payload,
-            timeout=30
+            data=orjson.dumps(payload),
+            timeout=timeout
         )
+        if response.status_code != 401:
+            break
+        response.close()
+        logger.warning("LLM API returned 401, refreshing API key")
+    return response
+
+def embedding_cache_key(text: str) -> str:
+    """Build the embedding cache key from the normalized query text"""
+    return "emb:q8:" + hashlib.sha256(text.strip().lower().encode('utf-8')).hexdigest()
+
+def quantize_embedding(embedding: List[float]) -> bytes:
+    """Pack an embedding as a float32 scale followed by int8 components"""
+    vector = np.asarray(embedding, dtype=np.float32)
+    scale = np.float32(np.abs(vector).max() / 127) or np.float32(1.0)
+    return scale.tobytes() + np.round(vector / scale).astype(np.int8).tobytes()
+
+def dequantize_embedding(value: bytes) -> List[float]:
+    """Unpack an embedding written by quantize_embedding"""
+    scale = np.frombuffer(value[:4], dtype=np.float32)[0]
+    return (np.frombuffer(value[4:], dtype=np.int8).astype(np.float32) * scale).tolist()
+
+def get_cached_embeddings(keys: List[str]) -> List[Optional[List[float]]]:
+    """Look up cached embeddings in one round-trip, treating any cache failure as a miss"""
+    if redis_client is None:
+        return [None] * len(keys)
+    try:
+        return [
+            dequantize_embedding(value) if value is not None else None
+            for value in redis_client.mget(keys)
+        ]
+    except Exception as e:
+        logger.warning(f"Embedding cache read failed: {str(e)}")
+        return [None] * len(keys)
+
+def cache_embeddings(keys: List[str], embeddings: List[List[float]]):
+    """Store int8-quantized embeddings with a TTL in one pipelined round-trip"""
+    if redis_client is None or not keys:
+        return
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for key, embedding in zip(keys, embeddings):
+            pipe.setex(key, EMBEDDING_CACHE_TTL, quantize_embedding(embedding))
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Embedding cache write failed: {str(e)}")
+
+def embed_batch(texts: List[str]) -> List[List[float]]:
+    """Embed one provider-sized batch of texts with a single external LLM API call"""
+    # Example for OpenAI API - adjust based on your LLM provider
+    payload = {
+        'input': texts,
+        'model': 'text-embedding-ada-002'
+    }
+    
+    response = post_to_llm('/embeddings', payload, timeout=30)
+    
+    if response.status_code == 200:
+        data = sorted(orjson.loads(response.content)['data'], key=lambda item: item['index'])
+        return [item['embedding'] for item in data]
+    else:
+        logger.error(f"Embedding API error: {response.status_code} - {response.text}")
+        raise Exception(f"Embedding generation failed: {response.status_code}")
+
+def generate_embeddings(texts: List[str], batch_size: int = EMBEDDING_BATCH_SIZE,
+                        max_inflight: int = EMBEDDING_MAX_INFLIGHT) -> List[List[float]]:
+    """Generate embeddings for texts, sending provider-sized batches with bounded concurrency"""
+    try:
+        cache_keys = [embedding_cache_key(text) for text in texts]
+        embeddings = get_cached_embeddings(cache_keys)
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        if not missing:
+            return embeddings
         
-        if response.status_code == 200:
-            return response.json()['data'][0]['embedding']
+        missing_texts = [texts[i] for i in missing]
+        batches = [missing_texts[i:i + batch_size] for i in range(0, len(missing_texts), batch_size)]
+        if len(batches) == 1:
+            # Default path: MAX_BATCH_QUERIES is below EMBEDDING_BATCH_SIZE, so one call covers every miss
+            batch_results = [embed_batch(batches[0])]
         else:
-            logger.error(f"Embedding API error: {response.status_code} - {response.text}")
-            raise Exception(f"Embedding generation failed: {response.status_code}")
+            # Provider batch cap lowered below the request batch size: fan out with bounded concurrency
+            with ThreadPoolExecutor(max_workers=min(max_inflight, len(batches))) as pool:
+                futures = []
+                for batch in batches:
+                    # Small jitter so concurrent batches don't hit the provider's rate limiter in lockstep
+                    time.sleep(random.random() * 0.02)
+                    futures.append(pool.submit(embed_batch, batch))
+                batch_results = [future.result() for future in futures]
+        
+        fresh = [embedding for batch in batch_results for embedding in batch]
+        for i, embedding in zip(missing, fresh):
+            embeddings[i] = embedding
+        cache_embeddings([cache_keys[i] for i in missing], fresh)
+        return embeddings
             
     except Exception as e:
         logger.error(f"Error generating embedding: {str(e)}")
         raise
 
-def search_similar_documents(query_embedding: List[float], top_k: int = 5) -> List[Dict[str, Any]]:
-    """Search for similar documents in OpenSearch"""
+def warm_opensearch_connection():
+    """Open the TLS connection to OpenSearch ahead of the first search in this container"""
+    global _opensearch_warmed
     try:
-        search_body = {
-            "size": top_k,
-            "query": {
-                "knn": {
-                    "embedding": {
-                        "vector": query_embedding,
-                        "k": top_k
-                    }
+        SESSION.head(
+            f"{OPENSEARCH_ENDPOINT}/{os.environ['VECTOR_INDEX_NAME']}",
+            auth=awsauth,
+            timeout=OPENSEARCH_TIMEOUT
+        )
+        _opensearch_warmed = True
+    except Exception as e:
+        logger.warning(f"OpenSearch warm-up failed: {str(e)}")
+
+def build_knn_query(query_embedding: List[float], top_k: int) -> Dict[str, Any]:
+    """Build the kNN search body, over-fetching candidates (with vectors) for the MMR rerank"""
+    fetch_k = MMR_FETCH_MULTIPLIER * top_k
+    # float32 serializes to ~9 significant digits instead of the 17 a Python float needs
+    return {
+        "size": fetch_k,
+        "query": {
+            "knn": {
+                "embedding": {
+                    "vector": np.asarray(query_embedding, dtype=np.float32),
+                    "k": fetch_k
                 }
-            },
-            "_source": ["content", "metadata", "title"]
-        }
+            }
+        },
+        "_source": ["content", "metadata", "title", "embedding"]
+    }
+
+def mmr_rerank(query_embedding: List[float], docs: List[Dict[str, Any]], top_k: int,
+               lambda_mult: Optional[float] = None) -> List[Dict[str, Any]]:
+    """Pick top_k diverse documents by Maximal Marginal Relevance and drop their vectors"""
+    if lambda_mult is None:
+        lambda_mult = MMR_LAMBDA
+    
+    if len(docs) > top_k and all(doc.get('embedding') for doc in docs):
+        doc_vectors = np.asarray([doc['embedding'] for doc in docs], dtype=np.float32)
+        doc_vectors /= np.maximum(np.linalg.norm(doc_vectors, axis=1, keepdims=True), 1e-12)
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        query_vector /= max(np.linalg.norm(query_vector), 1e-12)
         
-        response = opensearch_client.search(
-            index=os.environ['VECTOR_INDEX_NAME'],
-            body=search_body
+        query_sim = doc_vectors @ query_vector
+        doc_sim = doc_vectors @ doc_vectors.T
+        
+        selected = [int(np.argmax(query_sim))]
+        max_sim = doc_sim[selected[0]].copy()
+        while len(selected) < top_k:
+            scores = lambda_mult * query_sim - (1 - lambda_mult) * max_sim
+            scores[selected] = -np.inf
+            best = int(np.argmax(scores))
+            selected.append(best)
+            max_sim = np.maximum(max_sim, doc_sim[best])
+        docs = [docs[i] for i in selected]
+    else:
+        docs = docs[:top_k]
+    
+    return [{key: value for key, value in doc.items() if key != 'embedding'} for doc in docs]
+
+def search_similar_documents(query_embedding: List[float], top_k: int = 5, index: Optional[str] = None) -> List[Dict[str, Any]]:
+    """Search for similar documents in OpenSearch"""
+    try:
+        response = SESSION.post(
+            f"{OPENSEARCH_ENDPOINT}/{index or os.environ['VECTOR_INDEX_NAME']}/_search",
+            data=orjson.dumps(build_knn_query(query_embedding, top_k), option=orjson.OPT_SERIALIZE_NUMPY),
+            headers={'Content-Type': 'application/json'},
+            auth=awsauth,
+            timeout=OPENSEARCH_TIMEOUT
         )
         
-        return [hit['_source'] for hit in response['hits']['hits']]
+        if response.status_code != 200:
+            logger.error(f"OpenSearch error: {response.status_code} - {response.text}")
+            raise Exception(f"Document search failed: {response.status_code}")
+        
+        hits = orjson.loads(response.content)['hits']['hits']
+        return mmr_rerank(query_embedding, [hit['_source'] for hit in hits], top_k)
         
     except Exception as e:
         logger.error(f"Error searching documents: {str(e)}")
         raise
 
-def generate_rag_response(query: str, context_documents: List[Dict[str, Any]]) -> str:
-    """Generate response using external LLM with retrieved context"""
+def search_similar_documents_batch(query_embeddings: List[List[float]], indices: Optional[List[str]] = None,
+                                   top_k: int = 5) -> List[List[Dict[str, Any]]]:
+    """Run one kNN search per (embedding, index) pair in a single OpenSearch _msearch request"""
+    if indices is None:
+        indices = [os.environ['VECTOR_INDEX_NAME']] * len(query_embeddings)
+    if len(query_embeddings) == 1:
+        return [search_similar_documents(query_embeddings[0], top_k, indices[0])]
+    
     try:
-        secret = get_secret(LLM_API_KEY_SECRET)
-        api_key = secret['api_key']
+        lines = []
+        for query_embedding, index in zip(query_embeddings, indices):
+            lines.append(orjson.dumps({"index": index}))
+            lines.append(orjson.dumps(build_knn_query(query_embedding, top_k), option=orjson.OPT_SERIALIZE_NUMPY))
         
-        # Prepare context from retrieved documents
-        context = "\n\n".join([
-            f"Document: {doc.get('title', 'Unknown')}\n{doc.get('content', '')}"
-            for doc in context_documents
-        ])
+        response = SESSION.post(
+            f"{OPENSEARCH_ENDPOINT}/_msearch",
+            data=b"\n".join(lines) + b"\n",
+            headers={'Content-Type': 'application/x-ndjson'},
+            auth=awsauth,
+            timeout=OPENSEARCH_TIMEOUT
+        )
+        
+        # Older OpenSearch versions reject knn queries inside _msearch; search concurrently instead
+        if response.status_code == 400:
+            logger.warning(f"_msearch rejected, falling back to parallel searches: {response.text}")
+            return search_similar_documents_parallel(query_embeddings, indices, top_k)
         
-        # Create prompt with context
-        prompt = f"""Based on the following context, answer the user's question. If the answer cannot be found in the context, say so clearly.
+        if response.status_code != 200:
+            logger.error(f"OpenSearch error: {response.status_code} - {response.text}")
+            raise Exception(f"Document search failed: {response.status_code}")
+        
+        items = orjson.loads(response.content)['responses']
+        if any(is_msearch_knn_rejection(item) for item in items):
+            logger.warning("_msearch rejected knn queries, falling back to parallel searches")
+            return search_similar_documents_parallel(query_embeddings, indices, top_k)
+        
+        results = []
+        for query_embedding, item in zip(query_embeddings, items):
+            if 'error' in item:
+                raise Exception(f"kNN search failed: {item['error']}")
+            results.append(mmr_rerank(query_embedding, [hit['_source'] for hit in item['hits']['hits']], top_k))
+        return results
+        
+    except Exception as e:
+        logger.error(f"Error searching documents: {str(e)}")
+        raise
 
-Context:
-{context}
+def is_msearch_knn_rejection(item: Dict[str, Any]) -> bool:
+    """Tell whether an _msearch item failed because the cluster does not accept knn there"""
+    if 'error' not in item:
+        return False
+    return item.get('status') == 400 or 'knn' in orjson.dumps(item['error']).decode().lower()
 
-Question: {query}
+def search_similar_documents_parallel(query_embeddings: List[List[float]], indices: List[str],
+                                      top_k: int) -> List[List[Dict[str, Any]]]:
+    """Run the kNN searches as concurrent single-index requests"""
+    return list(executor.map(
+        lambda pair: search_similar_documents(pair[0], top_k, pair[1]),
+        zip(query_embeddings, indices)
+    ))
 
-Answer:"""
-        
-        headers = {
-            'Authorization': f'Bearer {api_key}',
-            'Content-Type': 'application/json'
-        }
-        
-        # Example for OpenAI API - adjust based on your LLM provider
-        payload = {
-            'model': 'gpt-4',
-            'messages': [
-                {
-                    'role': 'system',
-                    'content': 'You are a helpful assistant that answers questions based on provided context.'
-                },
-                {
-                    'role': 'user',
-                    'content': prompt
-                }
-            ],
-            'max_tokens': 500,
-            'temperature': 0.7
-        }
+# Static prompt fragments, built once per container
+_SYS = 'You are a helpful assistant that answers questions based on provided context.'
+_PROMPT_HEAD = ("Based on the following context, answer the user's question. "
+                "If the answer cannot be found in the context, say so clearly.\n\nContext:\n")
+
+# Tokenizer for bounding the prompt to the model's context window, loaded on first use
+_encoding = None
+_encoding_loaded = False
+_encoding_lock = threading.Lock()
+
+def get_encoding():
+    """Load the gpt-4 tokenizer from the bundled BPE cache; None means estimate tokens from length"""
+    global _encoding, _encoding_loaded
+    if _encoding_loaded:
+        return _encoding
+    # Executor threads may count tokens concurrently; only the first one loads, the rest wait for it
+    with _encoding_lock:
+        if not _encoding_loaded:
+            cache_dir = os.environ.get('TIKTOKEN_CACHE_DIR', '')
+            # Never let tiktoken download the BPE file at runtime (no egress inside a VPC, slow cold start)
+            if cache_dir and os.path.isdir(cache_dir) and os.listdir(cache_dir):
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.encoding_for_model('gpt-4')
+                except Exception as e:
+                    logger.warning(f"Tokenizer unavailable, estimating token counts: {str(e)}")
+            else:
+                logger.warning("TIKTOKEN_CACHE_DIR is not populated, estimating token counts")
+            _encoding_loaded = True
+    return _encoding
+
+def count_tokens(text: str) -> int:
+    """Count tokens with the tokenizer, or estimate ~4 characters per token without it"""
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """Cut text down to at most max_tokens tokens"""
+    encoding = get_encoding()
+    if encoding is None:
+        return text[:max_tokens * 4]
+    return encoding.decode(encoding.encode(text)[:max_tokens])
+
+def fit_context_to_budget(query: str, context_documents: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Keep documents in rank order until the prompt token budget is spent, truncating the last one"""
+    budget = (CONTEXT_TOKEN_LIMIT - count_tokens(_SYS) - count_tokens(_PROMPT_HEAD)
+              - count_tokens(query) - MAX_COMPLETION_TOKENS)
+    fitted = []
+    for doc in context_documents:
+        overhead = count_tokens(f"\n\nDocument: {doc.get('title') or 'Unknown'}\n")
+        content = str(doc.get('content') or '')
+        tokens = count_tokens(content)
+        if overhead + tokens <= budget:
+            fitted.append(doc)
+            budget -= overhead + tokens
+            continue
+        if budget - overhead > 0:
+            fitted.append({**doc, 'content': truncate_to_tokens(content, budget - overhead)})
+        logger.info(f"Context trimmed to {len(fitted)} of {len(context_documents)} documents to fit the token budget")
+        break
+    return fitted
+
+def build_rag_payload(query: str, context_documents: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Build the chat completion request for a query and its retrieved context"""
+    # Build the prompt in a single join instead of per-document f-strings
+    parts = [_PROMPT_HEAD]
+    ap = parts.append
+    for i, doc in enumerate(context_documents):
+        if i:
+            ap('\n\n')
+        ap('Document: ')
+        ap(str(doc.get('title') or 'Unknown'))
+        ap('\n')
+        ap(str(doc.get('content') or ''))
+    ap('\n\nQuestion: ')
+    ap(query)
+    ap('\n\nAnswer:')
+    prompt = ''.join(parts)
+    
+    # Example for OpenAI API - adjust based on your LLM provider
+    return {
+        'model': 'gpt-4',
+        'messages': [
+            {
+                'role': 'system',
+                'content': _SYS
+            },
+            {
+                'role': 'user',
+                'content': prompt
+            }
+        ],
+        'max_tokens': MAX_COMPLETION_TOKENS,
+        'temperature': 0.7
+    }
+
+def generate_rag_response(query: str, context_documents: List[Dict[str, Any]]) -> str:
+    """Generate response using external LLM with retrieved context"""
+    try:
+        payload = build_rag_payload(query, context_documents)
         
-        response = requests.post(
-            f"{EXTERNAL_LLM_ENDPOINT}/chat/completions",
-            headers=headers,
-            json=payload,
-            timeout=60
-        )
+        response = post_to_llm('/chat/completions', payload, timeout=60)
         
         if response.status_code == 200:
-            return response.json()['choices'][0]['message']['content']
+            return orjson.loads(response.content)['choices'][0]['message']['content']
         else:
             logger.error(f"LLM API error: {response.status_code} - {response.text}")
             raise Exception(f"LLM response generation failed: {response.status_code}")
@@ -166,28 +503,144 @@ Answer:"""
         logger.error(f"Error generating LLM response: {str(e)}")
         raise
 
-def publish_metrics(metric_name: str, value: float, unit: str = 'Count'):
-    """Publish custom metrics to CloudWatch"""
+def generate_fused_response(query: str) -> Optional[Tuple[str, List[Dict[str, Any]]]]:
+    """Answer via one Responses API call with file_search; None means fall back to OpenSearch"""
+    payload = {
+        'model': RESPONSES_MODEL,
+        'input': query,
+        'instructions': _SYS + ' If the answer cannot be found in the context, say so clearly.',
+        'tools': [{'type': 'file_search', 'vector_store_ids': [LLM_VECTOR_STORE_ID]}],
+        'max_output_tokens': MAX_COMPLETION_TOKENS
+    }
+    
     try:
-        cloudwatch.put_metric_data(
-            Namespace='RAG/Application',
-            MetricData=[
-                {
-                    'MetricName': metric_name,
-                    'Value': value,
-                    'Unit': unit,
-                    'Dimensions': [
-                        {
-                            'Name': 'Environment',
-                            'Value': os.environ.get('ENVIRONMENT', 'dev')
-                        }
-                    ]
-                }
-            ]
-        )
+        response = post_to_llm('/responses', payload, timeout=60)
+        if response.status_code != 200:
+            logger.warning(f"Responses API error: {response.status_code} - {response.text}")
+            return None
+        
+        result = orjson.loads(response.content)
+        if result.get('error'):
+            logger.warning(f"Responses API tool error: {result['error']}")
+            return None
+        
+        answer_parts = []
+        sources = []
+        cited_file_ids = set()
+        for item in result.get('output', []):
+            if item.get('type') != 'message':
+                continue
+            for content in item.get('content', []):
+                if content.get('type') != 'output_text':
+                    continue
+                answer_parts.append(content.get('text', ''))
+                for annotation in content.get('annotations', []):
+                    if annotation.get('type') == 'file_citation' and annotation.get('file_id') not in cited_file_ids:
+                        cited_file_ids.add(annotation.get('file_id'))
+                        sources.append({
+                            'title': annotation.get('filename', 'Unknown'),
+                            'content_preview': '',
+                            'metadata': {'file_id': annotation.get('file_id')}
+                        })
+        
+        if not answer_parts:
+            return None
+        return "".join(answer_parts), sources
+        
+    except Exception as e:
+        logger.warning(f"Fused response generation failed, falling back: {str(e)}")
+        return None
+
+def publish_metrics(metrics: List[Tuple[str, float, str]]):
+    """Publish custom metrics to CloudWatch as one Embedded Metric Format log line"""
+    try:
+        environment = os.environ.get('ENVIRONMENT', 'dev')
+        emf = {
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [
+                    {
+                        'Namespace': 'RAG/Application',
+                        'Dimensions': [['Environment']],
+                        'Metrics': [{'Name': name, 'Unit': unit} for name, _, unit in metrics]
+                    }
+                ]
+            },
+            'Environment': environment
+        }
+        for name, value, _ in metrics:
+            emf[name] = value
+        print(orjson.dumps(emf).decode())
     except Exception as e:
         logger.error(f"Error publishing metrics: {str(e)}")
 
+def build_sources(docs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Summarize retrieved documents for the API response"""
+    sources = []
+    for doc in docs:
+        content = str(doc.get('content') or '')
+        sources.append({
+            'title': str(doc.get('title') or 'Unknown'),
+            'content_preview': content[:200] + '...' if len(content) > 200 else content,
+            'metadata': doc.get('metadata', {})
+        })
+    return sources
+
+def answer_queries(queries: List[str]) -> List[Dict[str, Any]]:
+    """Run the RAG pipeline for a batch of queries, sharing the embedding and search round-trips"""
+    results: List[Optional[Dict[str, Any]]] = [None] * len(queries)
+    
+    # Collapse embed, search and generate into one call when a provider vector store is configured
+    if LLM_VECTOR_STORE_ID:
+        for i, fused in enumerate(executor.map(generate_fused_response, queries)):
+            if fused is not None:
+                answer, sources = fused
+                results[i] = {'answer': answer, 'sources': sources, 'query': queries[i]}
+    
+    pending = [i for i, result in enumerate(results) if result is None]
+    if not pending:
+        return results
+    
+    # Generate embeddings for the queries while the OpenSearch connection warms up
+    embedding_future = executor.submit(generate_embeddings, [queries[i] for i in pending])
+    warmup_future = None if _opensearch_warmed else executor.submit(warm_opensearch_connection)
+    query_embeddings = embedding_future.result()
+    if warmup_future is not None:
+        warmup_future.result()
+    
+    # Search for similar documents
+    docs_per_query = search_similar_documents_batch(query_embeddings)
+    
+    # Trim context to the token budget once so the prompt and the cited sources match
+    docs_per_query = [
+        fit_context_to_budget(queries[i], similar_docs)
+        for i, similar_docs in zip(pending, docs_per_query)
+    ]
+    
+    # Generate RAG responses concurrently
+    answer_futures = {
+        i: executor.submit(generate_rag_response, queries[i], similar_docs)
+        for i, similar_docs in zip(pending, docs_per_query)
+        if similar_docs
+    }
+    
+    for i, similar_docs in zip(pending, docs_per_query):
+        if not similar_docs:
+            results[i] = {
+                'answer': 'I could not find relevant information to answer your question.',
+                'sources': [],
+                'query': queries[i]
+            }
+            continue
+        
+        results[i] = {
+            'answer': answer_futures[i].result(),
+            'sources': build_sources(similar_docs),
+            'query': queries[i]
+        }
+    
+    return results
+
 def lambda_handler(event, context):
     """Main Lambda handler for RAG queries"""
     start_time = context.get_remaining_time_in_millis()
@@ -195,64 +648,60 @@ def lambda_handler(event, context):
     try:
         # Parse request body
         if isinstance(event.get('body'), str):
-            body = json.loads(event['body'])
+            body = orjson.loads(event['body'])
         else:
             body = event.get('body', {})
         
-        query = body.get('query', '').strip()
-        if not query:
+        # Accept either a single 'query' or a batch of 'queries'
+        is_batch = 'queries' in body
+        raw_queries = body.get('queries') if is_batch else [body.get('query', '')]
+        if not isinstance(raw_queries, list):
+            raw_queries = []
+        queries = [q.strip() for q in raw_queries if isinstance(q, str)]
+        if not queries or len(queries) != len(raw_queries) or not all(queries):
             return {
                 'statusCode': 400,
                 'headers': {
                     'Content-Type': 'application/json',
                     'Access-Control-Allow-Origin': '*'
                 },
-                'body': json.dumps({'error': 'Query is required'})
+                'body': orjson.dumps({'error': 'Query is required'}).decode()
             }
         
-        logger.info(f"Processing query: {query}")
-        
-        # Generate embedding for the query
-        query_embedding = generate_embedding(query)
-        
-        # Search for similar documents
-        similar_docs = search_similar_documents(query_embedding)
+        if len(queries) > MAX_BATCH_QUERIES:
+            return {
+                'statusCode': 413,
+                'headers': {
+                    'Content-Type': 'application/json',
+                    'Access-Control-Allow-Origin': '*'
+                },
+                'body': orjson.dumps({'error': f'Batch exceeds {MAX_BATCH_QUERIES} queries'}).decode()
+            }
         
-        if not similar_docs:
+        if any(len(query) > MAX_QUERY_CHARS for query in queries):
             return {
-                'statusCode': 200,
+                'statusCode': 413,
                 'headers': {
                     'Content-Type': 'application/json',
                     'Access-Control-Allow-Origin': '*'
                 },
-                'body': json.dumps({
-                    'answer': 'I could not find relevant information to answer your question.',
-                    'sources': []
-                })
+                'body': orjson.dumps({'error': f'Query exceeds {MAX_QUERY_CHARS} characters'}).decode()
             }
         
-        # Generate RAG response
-        answer = generate_rag_response(query, similar_docs)
+        logger.info(f"Processing {len(queries)} queries: {queries}")
+        
+        results = answer_queries(queries)
         
         # Prepare response
-        response_data = {
-            'answer': answer,
-            'sources': [
-                {
-                    'title': doc.get('title', 'Unknown'),
-                    'content_preview': doc.get('content', '')[:200] + '...' if len(doc.get('content', '')) > 200 else doc.get('content', ''),
-                    'metadata': doc.get('metadata', {})
-                }
-                for doc in similar_docs
-            ],
-            'query': query
-        }
+        response_data = {'results': results} if is_batch else results[0]
         
         # Publish metrics
         processing_time = (start_time - context.get_remaining_time_in_millis()) / 1000
-        publish_metrics('QueryProcessingTime', processing_time, 'Seconds')
-        publish_metrics('DocumentsRetrieved', len(similar_docs), 'Count')
-        publish_metrics('QueriesProcessed', 1, 'Count')
+        publish_metrics([
+            ('QueryProcessingTime', processing_time, 'Seconds'),
+            ('DocumentsRetrieved', sum(len(result['sources']) for result in results), 'Count'),
+            ('QueriesProcessed', len(queries), 'Count')
+        ])
         
         return {
             'statusCode': 200,
@@ -260,14 +709,14 @@ def lambda_handler(event, context):
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps(response_data)
+            'body': orjson.dumps(response_data).decode()
         }
         
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}")
         
         # Publish error metrics
-        publish_metrics('QueryErrors', 1, 'Count')
+        publish_metrics([('QueryErrors', 1, 'Count')])
         
         return {
             'statusCode': 500,
@@ -275,8 +724,8 @@ def lambda_handler(event, context):
                 'Content-Type': 'application/json',
                 'Access-Control-Allow-Origin': '*'
             },
-            'body': json.dumps({
+            'body': orjson.dumps({
                 'error': 'Internal server error',
                 'message': str(e) if os.environ.get('ENVIRONMENT') == 'dev' else 'An error occurred processing your request'
-            })
-        }
\ No newline at end of file
+            }).decode()
+        }
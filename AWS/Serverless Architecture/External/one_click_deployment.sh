@@ -110,12 +110,14 @@ create_project_structure() {
 boto3==1.26.137
 opensearch-py==2.2.0
 requests==2.31.0
-aws-requests-auth==0.4.3
 python-multipart==0.0.6
 PyPDF2==3.0.1
 python-docx==0.8.11
 beautifulsoup4==4.12.2
 numpy==1.24.3
+redis==4.6.0
+orjson==3.9.15
+tiktoken==0.5.2
 scikit-learn==1.2.2
 EOF
     
@@ -125,6 +127,14 @@ EOF
     cp requirements.txt src/embedding_generator/
     cp requirements.txt src/document_upload/
     
+    # Bundle the tiktoken BPE file so the query processor never downloads it at runtime
+    mkdir -p src/query_processor/tiktoken_cache
+    if python3 -c "import tiktoken" &> /dev/null; then
+        TIKTOKEN_CACHE_DIR=src/query_processor/tiktoken_cache python3 -c "import tiktoken; tiktoken.get_encoding('cl100k_base')"
+    else
+        print_warning "tiktoken is not installed locally; the query processor will estimate prompt token counts"
+    fi
+    
     print_success "Project structure created!"
 }
 